@@ -6,25 +6,24 @@ Convenience runner:
 3) python app.py
 """
 import os
-import json
-import subprocess
-import sys
+import shutil
 
 CONFIG = "config.json"
 """
 If not present, a config.json will be created from config.example.json
 """
 if not os.path.exists(CONFIG):
-    with open("config.example.json", "r") as f:
-        example = json.load(f)
-        
-    with open(CONFIG, "w") as f:
-        json.dump(example, f, indent=2)
+    # copy the example byte-for-byte ("x" creates atomically), no
+    # JSON parse + reserialize
+    with open("config.example.json", "r") as example, open(CONFIG, "x") as f:
+        shutil.copyfileobj(example, f)
     print("Created config.json from example.")
 
 if "GEMINI_API_KEY" not in os.environ:
     print("Warning: GEMINI_API_KEY not set. The pipeline will use rule-based fallbacks.")
-print("Running autogen_pipeline.py...")
+print("Running autogen_pipeline...")
 
-subprocess.run([sys.executable, "autogen_pipeline.py"], check=True)
+from autogen_pipeline import main
+
+main()
 print("Done.")
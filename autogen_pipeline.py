@@ -1,27 +1,45 @@
     # autogen_pipeline.py
 """
-AutoGen-based orchestration for the Gemini-powered feedback pipeline.
-- AutoGen handles agent roles & conversation skeleton.
+Orchestration for the Gemini-powered feedback pipeline.
 - Gemini (google-generativeai) does the core reasoning (classification, extraction, critique).
+- Routing between the steps is plain Python via the tool functions.
 - If GEMINI_API_KEY is missing, deterministic fallbacks are used.
 """
 from __future__ import annotations
 import os
+import csv
 import json
+import asyncio
 import pandas as pd
+from collections import OrderedDict
+from dataclasses import asdict
+from datetime import datetime
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from typing import Dict, Any
 
-# from autogen import AssistantAgent, UserProxyAgent, GroupChat, GroupChatManager
-from autogen.agentchat import AssistantAgent, UserProxyAgent, GroupChat, GroupChatManager
-
 from gemini_client import GeminiClient
+from prompts import (
+    SYSTEM_CLASSIFIER,
+    SYSTEM_BUG_ANALYZER,
+    SYSTEM_FEATURE_EXTRACTOR,
+    SYSTEM_TICKET_CREATOR,
+)
 from tools_gemini import (
     read_csv_file,
-    classify_with_gemini,
-    analyze_bug_with_gemini,
-    extract_feature_with_gemini,
-    compose_ticket_with_gemini,
-    critic_with_gemini,
+    iter_csv_chunks,
+    classify_with_gemini_async,
+    analyze_bug_with_gemini_async,
+    extract_feature_with_gemini_async,
+    compose_ticket_with_gemini_async,
+    critic_with_gemini_async,
+    fallback_classify,
+    fallback_classify_series,
+    fallback_bug_analysis,
+    fallback_feature,
+    fallback_critic,
+    cluster_duplicate_texts,
+    Ticket,
     create_ticket,
     compute_metrics,
 )
@@ -33,55 +51,166 @@ def load_config(path: str) -> Dict[str, Any]:
 def save_df(df: pd.DataFrame, path: str):
     df.to_csv(path, index=False)
 
+def row_key_fields(rec: Dict[str, Any]):
+    sid = str(rec.get("review_id", rec.get("email_id", "")))
+    text = rec.get("review_text") or rec.get("body") or ""
+    rating = rec.get("rating", None)
+    platform = rec.get("platform", rec.get("device", "Unknown"))
+    version = rec.get("app_version", rec.get("appVersion", "Unknown"))
+    return sid, text, rating, platform, version
+
+def row_to_ticket_pure(rec: Dict[str, Any], fallback_cat=None, source_type: str = "",
+                       run_ts: str = "") -> Dict[str, Any]:
+    """
+    Fallback-only version of row_to_ticket: pure CPU (trigger scans and dict
+    lookups), no Gemini client, and picklable so it can run in worker
+    processes. fallback_cat optionally carries this row's category as
+    precomputed by the vectorized classifier.
+    """
+    sid, text, rating, platform, version = row_key_fields(rec)
+    category, conf, _ = fallback_cat or fallback_classify(text, rating)
+
+    priority = "Low"
+    title_hint = text[:72] or f"{category} item"
+    details = f"Summary={text[:240]}"
+    if category == "Bug":
+        severity, details, _ = fallback_bug_analysis(text, platform, version)
+        priority = {"Critical": "Critical", "High": "High", "Medium": "Medium", "Low": "Low"}.get(severity, "Medium")
+        title_hint = f"Bug: {text[:72]}"
+    elif category == "Feature Request":
+        impact, details, suggested_title = fallback_feature(text)
+        priority = {"High": "High", "Medium": "Medium", "Low": "Low"}.get(impact, "Low")
+        title_hint = suggested_title or f"Feature: {text[:72]}"
+    elif category == "Complaint":
+        priority = "Medium"
+        details = f"Complaint: {text[:240]}"
+        title_hint = f"Complaint: {text[:72]}"
+    elif category == "Praise":
+        details = "Positive feedback"
+        title_hint = "Praise"
+    elif category == "Spam":
+        details = "Likely spam"
+        title_hint = "Spam"
+
+    t = create_ticket(
+        sid,
+        source_type,
+        category,
+        priority,
+        title_hint[:80],
+        details[:400],
+        float(conf),
+        rec.get("url", ""),
+        created_at=run_ts,
+    )
+    return fallback_critic(asdict(t))
+
 def main(config_path: str = "config.json"):
-    cfg = load_config(config_path if os.path.exists("config.json") else "config.example.json")
+    cfg_file = config_path if os.path.exists(config_path) else "config.example.json"
+    cfg = load_config(cfg_file)
     gemini_cfg = cfg.get("gemini", {})
     g = GeminiClient(
         model=gemini_cfg.get("model", "gemini-1.5-flash"),
         temperature=float(gemini_cfg.get("temperature", 0.2)),
         top_p=float(gemini_cfg.get("top_p", 0.95)),
         top_k=int(gemini_cfg.get("top_k", 40)),
+        cache=bool(gemini_cfg.get("cache", True)),
+        service_tier=gemini_cfg.get("service_tier", "flex"),
     )
 
-    # --- Define agents (LLM disabled internally; we call Gemini explicitly via tools) ---
-    reader = AssistantAgent(name="CSVReaderAgent", llm_config=False)
-    classifier = AssistantAgent(name="FeedbackClassifierAgent", llm_config=False)
-    bugger = AssistantAgent(name="BugAnalysisAgent", llm_config=False)
-    featurex = AssistantAgent(name="FeatureExtractorAgent", llm_config=False)
-    ticketor = AssistantAgent(name="TicketCreatorAgent", llm_config=False)
-    critic = AssistantAgent(name="QualityCriticAgent", llm_config=False)
-    logger = AssistantAgent(name="LoggerAgent", llm_config=False)
-
-    user = UserProxyAgent(
-        name="Orchestrator",
-        human_input_mode="NEVER",
-        code_execution_config=False,
-        system_message="Coordinates the pipeline deterministically; Gemini is called from tools."
-    )
-
-    groupchat = GroupChat(agents=[user, reader, classifier, bugger, featurex, ticketor, critic, logger], messages=[])
-    manager = GroupChatManager(groupchat=groupchat, llm_config=False)
-
     files = cfg["files"]
     reviews_csv = files.get("app_store_reviews", "app_store_reviews.csv")
     support_csv = files.get("support_emails", "support_emails.csv")
     expected_csv = files.get("expected_classifications", "expected_classifications.csv")
 
-    if os.path.exists(reviews_csv):
-        df_reviews = read_csv_file(reviews_csv)
-    else:
-        df_reviews = pd.DataFrame()
-        
-    if support_csv and os.path.exists(support_csv):
-        df_support = read_csv_file(support_csv)
-    else:
-        df_support = pd.DataFrame()
-
-    def row_to_ticket(row: pd.Series, source_type: str):
+    # One timestamp for the whole run; all tickets share it.
+    run_ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    # --- Optional Batch API mode: two batch jobs for the whole run instead
+    # of ~4N round-trips. Stage 1 classifies every row in one job; stage 2
+    # runs the per-category analysis + ticket composition keyed like
+    # "{sid}:bug". Results land in a plain dict so row_to_ticket becomes
+    # lookups with fallback_* for misses.
+    use_batch = g.enabled and bool(gemini_cfg.get("use_batch", False))
+    batch_results = None
+
+    def build_batch_results(all_rows):
+        classify_reqs = []
+        for r in all_rows:
+            sid, text, rating, _, _ = row_key_fields(r)
+            payload = {"text": text, "rating": rating}
+            classify_reqs.append({
+                "key": sid,
+                "prompt": GeminiClient.build_prompt(SYSTEM_CLASSIFIER, json.dumps(payload)),
+            })
+        print(f"Submitting classification batch ({len(classify_reqs)} prompts)...")
+        results = g.fetch_batch(g.submit_batch(classify_reqs))
+
+        stage2_reqs = []
+        for r in all_rows:
+            sid, text, rating, platform, version = row_key_fields(r)
+            out = results.get(sid)
+            if isinstance(out, dict) and "category" in out:
+                category = out.get("category", "Other")
+            else:
+                category, _, _ = fallback_classify(text, rating)
+            if category == "Bug":
+                hint_title = f"Bug: {text[:72]}"
+                hint_body = fallback_bug_analysis(text, platform, version)[1]
+                stage2_reqs.append({
+                    "key": f"{sid}:bug",
+                    "prompt": GeminiClient.build_prompt(
+                        SYSTEM_BUG_ANALYZER,
+                        json.dumps({"text": text, "platform": platform, "version": version})),
+                })
+            elif category == "Feature Request":
+                hint_title = f"Feature: {text[:72]}"
+                hint_body = fallback_feature(text)[1]
+                stage2_reqs.append({
+                    "key": f"{sid}:feature",
+                    "prompt": GeminiClient.build_prompt(
+                        SYSTEM_FEATURE_EXTRACTOR, json.dumps({"text": text})),
+                })
+            elif category == "Complaint":
+                hint_title = f"Complaint: {text[:72]}"
+                hint_body = f"Complaint: {text[:240]}"
+            elif category == "Praise":
+                hint_title = "Praise"
+                hint_body = "Positive feedback"
+            elif category == "Spam":
+                hint_title = "Spam"
+                hint_body = "Likely spam"
+            else:
+                hint_title = text[:72] or f"{category} item"
+                hint_body = f"Summary={text[:240]}"
+            stage2_reqs.append({
+                "key": f"{sid}:compose",
+                "prompt": GeminiClient.build_prompt(
+                    SYSTEM_TICKET_CREATOR,
+                    json.dumps({"title_hint": hint_title[:120], "body_hint": hint_body[:500]})),
+            })
+        print(f"Submitting analysis/compose batch ({len(stage2_reqs)} prompts)...")
+        results.update(g.fetch_batch(g.submit_batch(stage2_reqs)))
+        return results
+
+    # When Gemini is disabled, classify whole columns up front in one
+    # vectorized pass instead of per-row trigger scans inside row_to_ticket.
+    # Returns one (category, confidence, rationale) tuple per row, in record
+    # order, so each worker task pickles only its own row's result.
+    def build_fallback_cats(df: pd.DataFrame):
+        texts = df["review_text"] if "review_text" in df.columns else df.get("body", pd.Series("", index=df.index))
+        ratings = df.get("rating", pd.Series(index=df.index, dtype=float))
+        cls = fallback_classify_series(texts, ratings)
+        return [
+            (cat, float(conf), rat)
+            for cat, conf, rat in zip(cls["category"], cls["confidence"], cls["rationale"])
+        ]
+
+    async def row_to_ticket(rec: Dict[str, Any], source_type: str):
         """
-        Converts a pandas Series representing a user review or feedback row into a structured ticket object.
+        Converts a record dict representing a user review or feedback row into a structured ticket object.
         Args:
-            row (pd.Series): The input row containing review or feedback data.
+            rec (dict): The input row containing review or feedback data.
             source_type (str): The source type identifier (e.g., "AppStore", "Email").
         Returns:
             Ticket: A ticket object created from the row data, containing fields such as ID, source type, category,
@@ -94,24 +223,51 @@ def main(config_path: str = "config.json"):
             - Composes a ticket title and body using Gemini.
             - Returns a ticket object with all relevant information.
         """
-        text = row.get("review_text") or row.get("body") or ""
-        rating = row.get("rating", None)
-        category, conf, _ = classify_with_gemini(g, text, rating)
+        sid, text, rating, platform, version = row_key_fields(rec)
+        if batch_results is not None:
+            out = batch_results.get(sid)
+            if isinstance(out, dict) and "category" in out:
+                category = out.get("category", "Other")
+                conf = float(out.get("confidence", 0.6))
+            else:
+                category, conf, _ = fallback_classify(text, rating)
+        else:
+            # cheap pre-filter: rows the rules classify as Spam/Praise with
+            # high confidence skip the LLM classify call entirely
+            cat0, conf0, _ = fallback_classify(text, rating)
+            if cat0 in ("Spam", "Praise") and conf0 >= 0.9:
+                category, conf = cat0, conf0
+            else:
+                category, conf, _ = await classify_with_gemini_async(g, text, rating)
 
         priority = "Low"
         title_hint = text[:72] or f"{category} item"
         details = f"Summary={text[:240]}"
 
-        platform = row.get("platform", row.get("device", "Unknown"))
-        version = row.get("app_version", row.get("appVersion", "Unknown"))
         if category == "Bug":
-            severity, tech_details, _ = analyze_bug_with_gemini(g, text, platform, version)
+            if batch_results is not None:
+                out = batch_results.get(f"{sid}:bug")
+                if isinstance(out, dict) and "severity" in out:
+                    severity, tech_details = out.get("severity", "Medium"), out.get("technical_details", "")
+                else:
+                    severity, tech_details, _ = fallback_bug_analysis(text, platform, version)
+            else:
+                severity, tech_details, _ = await analyze_bug_with_gemini_async(g, text, platform, version)
             details = tech_details
             # map severity -> priority
             priority = {"Critical": "Critical", "High": "High", "Medium": "Medium", "Low": "Low"}.get(severity, "Medium")
             title_hint = f"Bug: {text[:72]}"
         elif category == "Feature Request":
-            impact, feat_details, suggested_title = extract_feature_with_gemini(g, text)
+            if batch_results is not None:
+                out = batch_results.get(f"{sid}:feature")
+                if isinstance(out, dict) and "impact" in out:
+                    impact = out.get("impact", "Low")
+                    feat_details = out.get("details", f"Feature: {text[:140]}")
+                    suggested_title = out.get("suggested_title", "Feature")
+                else:
+                    impact, feat_details, suggested_title = fallback_feature(text)
+            else:
+                impact, feat_details, suggested_title = await extract_feature_with_gemini_async(g, text)
             details = feat_details
             priority = {"High": "High", "Medium": "Medium", "Low": "Low"}.get(impact, "Low")
             title_hint = suggested_title or f"Feature: {text[:72]}"
@@ -128,10 +284,20 @@ def main(config_path: str = "config.json"):
             details = "Likely spam"
             title_hint = "Spam"
 
-        title, body = compose_ticket_with_gemini(g, title_hint, details)
-        link_back = row.get("url", "")
+        if batch_results is not None:
+            out = batch_results.get(f"{sid}:compose")
+            if isinstance(out, dict) and "title" in out and "body" in out:
+                title, body = out["title"][:80], out["body"]
+            else:
+                title, body = title_hint[:80], details[:400]
+        elif category in ("Spam", "Praise"):
+            # trivial tickets: deterministic title/body, no compose call
+            title, body = title_hint[:80], details[:400]
+        else:
+            title, body = await compose_ticket_with_gemini_async(g, title_hint, details)
+        link_back = rec.get("url", "")
         t = create_ticket(
-            str(row.get("review_id", row.get("email_id", ""))),
+            sid,
             source_type,
             category,
             priority,
@@ -139,54 +305,161 @@ def main(config_path: str = "config.json"):
             body if body else details,
             float(conf),
             link_back,
+            created_at=run_ts,
         )
         return t
 
+    # Rows are I/O-bound (HTTPS latency), so process them concurrently; a
+    # semaphore bounds in-flight requests to stay inside Gemini rate limits.
+    concurrency = int(gemini_cfg.get("concurrency", 32))
+
+    # Exact-duplicate memo, keyed on normalized text + row metadata. Unlike
+    # the per-chunk clustering it persists across chunks and sources; the cap
+    # bounds memory on huge runs (oldest entries evicted first).
+    memo: OrderedDict = OrderedDict()
+    memo_cap = 10_000
+
+    def memo_key(text, rating, platform, version):
+        if rating is not None and rating != rating:  # NaN never equals itself
+            rating = None
+        return (text.strip().lower(), rating, platform, version)
+
+    async def process_row(rec: Dict[str, Any], source_type: str, sem: asyncio.Semaphore):
+        sid, text, rating, platform, version = row_key_fields(rec)
+        key = memo_key(text, rating, platform, version)
+        cached = memo.get(key)
+        if cached is not None:
+            t = create_ticket(
+                sid,
+                source_type,
+                cached["category"],
+                cached["priority"],
+                cached["title"],
+                cached["technical_details"],
+                cached["confidence"],
+                rec.get("url", ""),
+                created_at=run_ts,
+            )
+            return asdict(t)
+        async with sem:
+            t = await row_to_ticket(rec, source_type)
+            td = asdict(t)
+            td = fallback_critic(td) if batch_results is not None else await critic_with_gemini_async(g, td)
+            print(f"Processed {source_type}: {td.get('source_id', '')}")
+        memo[key] = td
+        if len(memo) > memo_cap:
+            memo.popitem(last=False)
+        return td
+
+    async def run_chunk(rows, sem: asyncio.Semaphore):
+        # Call Gemini once per duplicate cluster and copy the result to
+        # siblings; singletons go through the full pipeline as before.
+        texts = [row_key_fields(r)[1] for r, _ in rows]
+        clusters = cluster_duplicate_texts(texts)
+        rep_tds = await asyncio.gather(*(process_row(*rows[c[0]], sem) for c in clusters))
+        results = [None] * len(rows)
+        for cluster, rep_td in zip(clusters, rep_tds):
+            results[cluster[0]] = rep_td
+            for i in cluster[1:]:
+                rec, source_type = rows[i]
+                sid, _, _, _, _ = row_key_fields(rec)
+                t = create_ticket(
+                    sid,
+                    source_type,
+                    rep_td["category"],
+                    rep_td["priority"],
+                    rep_td["title"],
+                    rep_td["technical_details"],
+                    rep_td["confidence"],
+                    rec.get("url", ""),
+                    created_at=run_ts,
+                )
+                results[i] = asdict(t)
+        return results
+
+    # Stream each source CSV in chunks: bounded memory, and tickets go
+    # straight to an open DictWriter as their chunk finishes. The 1 MiB file
+    # buffer batches the syscalls; no per-row flush.
+    chunk_rows = int(cfg.get("chunk_rows", 1024))
+    tickets_path = files.get("generated_tickets", "generated_tickets.csv")
+    log_path = files.get("processing_log", "processing_log.csv")
+    log_fields = ["source_id", "source_type", "category", "priority", "confidence"]
     processing_rows = []
-    tickets = []
-
-    # Process app store reviews
-    for _, r in df_reviews.iterrows():
-        print(f"Processing App Store Review: {r.get('review_id', '')}")
-        t = row_to_ticket(r, "App Store Review")
-        td = t.__dict__.copy()
-        td = critic_with_gemini(g, td)
-        tickets.append(td)
-        print(f"Processed App Store Review: {td.get('source_id', '')}")
-        processing_rows.append({
-            "source_id": td["source_id"],
-            "source_type": "App Store Review",
-            "category": td["category"],
-            "priority": td["priority"],
-            "confidence": td["confidence"]
-        })
-
-    # Process support emails (optional)
-    for _, r in df_support.iterrows():
-        t = row_to_ticket(r, "Support Email")
-        td = t.__dict__.copy()
-        td = critic_with_gemini(g, td)
-        tickets.append(td)
-        processing_rows.append({
-            "source_id": td["source_id"],
-            "source_type": "Support Email",
-            "category": td["category"],
-            "priority": td["priority"],
-            "confidence": td["confidence"]
-        })
-
-    tickets_df = pd.DataFrame(tickets)
+    total_tickets = 0
+
+    # Fallback-only runs are CPU-bound string matching, so spread them over
+    # the cores; async I/O wins when Gemini is enabled, so skip the pool then.
+    pool = None if g.enabled else ProcessPoolExecutor(max_workers=os.cpu_count())
+
+    sources = [(reviews_csv, "App Store Review"), (support_csv, "Support Email")]
+
+    async def run_all():
+        # One event loop for the whole run. The SDK caches its async client
+        # (and its grpc aio channel) bound to the first loop it sees, so an
+        # asyncio.run per chunk would crash on chunk 2 with "Event loop is
+        # closed". The semaphore lives here for the same reason.
+        nonlocal batch_results, total_tickets
+        sem = asyncio.Semaphore(concurrency)
+        with open(tickets_path, "w", newline="", buffering=1 << 20) as tf, \
+             open(log_path, "w", newline="", buffering=1 << 20) as lf:
+            ticket_writer = csv.DictWriter(tf, fieldnames=list(Ticket.__dataclass_fields__), extrasaction="ignore")
+            ticket_writer.writeheader()
+            log_writer = csv.DictWriter(lf, fieldnames=log_fields)
+            log_writer.writeheader()
+
+            def write_rows(tds):
+                nonlocal total_tickets
+                for td in tds:
+                    ticket_writer.writerow(td)
+                    log_row = {k: td[k] for k in log_fields}
+                    log_writer.writerow(log_row)
+                    processing_rows.append(log_row)
+                total_tickets += len(tds)
+
+            if use_batch:
+                # Batch jobs carry fixed submit + polling overhead, so read
+                # every source up front and submit one classify job and one
+                # analysis/compose job for the entire run, not two per chunk.
+                all_rows = []
+                for path, source_type in sources:
+                    if not (path and os.path.exists(path)):
+                        continue
+                    for df_chunk in iter_csv_chunks(path, chunk_rows=chunk_rows):
+                        all_rows.extend((rec, source_type) for rec in df_chunk.to_dict("records"))
+                batch_results = build_batch_results([rec for rec, _ in all_rows])
+                for start in range(0, len(all_rows), chunk_rows):
+                    write_rows(await run_chunk(all_rows[start:start + chunk_rows], sem))
+                return
+            for path, source_type in sources:
+                if not (path and os.path.exists(path)):
+                    continue
+                for df_chunk in iter_csv_chunks(path, chunk_rows=chunk_rows):
+                    recs = df_chunk.to_dict("records")
+                    if not recs:
+                        continue
+                    if pool is not None:
+                        tds = list(pool.map(
+                            partial(row_to_ticket_pure, source_type=source_type, run_ts=run_ts),
+                            recs, build_fallback_cats(df_chunk), chunksize=256))
+                    else:
+                        tds = await run_chunk([(rec, source_type) for rec in recs], sem)
+                    write_rows(tds)
+
+    try:
+        asyncio.run(run_all())
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
     log_df = pd.DataFrame(processing_rows)
 
     expected_df = read_csv_file(expected_csv) if expected_csv and os.path.exists(expected_csv) else None
     metrics_df = compute_metrics(log_df, expected_df)
 
-    save_df(tickets_df, files.get("generated_tickets", "generated_tickets.csv"))
-    save_df(log_df, files.get("processing_log", "processing_log.csv"))
     save_df(metrics_df, files.get("metrics", "metrics.csv"))
 
     print("=== Done ===")
-    print(f"Generated tickets: {len(tickets_df)}")
+    print(f"Generated tickets: {total_tickets}")
     print(metrics_df.to_string(index=False))
 
 if __name__ == "__main__":
@@ -1,25 +1,176 @@
 # gemini_client.py
 import os
+import re
 import json
-from typing import Optional, Dict, Any
+import time
+import random
+import asyncio
+import hashlib
+import sqlite3
+import tempfile
+from typing import Optional, Dict, Any, List
 import google.generativeai as genai
 
+try:
+    from google.api_core import exceptions as _gexc
+    _RETRYABLE_ERRORS = (_gexc.ResourceExhausted, _gexc.ServiceUnavailable)  # 429 / 503
+except ImportError:
+    _RETRYABLE_ERRORS = ()
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+_JSON_RE = re.compile(r"\{.*\}", re.S)
+
+# The system-prompt preamble is identical across thousands of calls;
+# assemble it once per prompt instead of re-formatting every time.
+_PROMPT_PREFIXES: Dict[str, str] = {}
+_PROMPT_SUFFIX = "\n\nReturn a valid JSON only."
+
 class GeminiClient:
-    def __init__(self, model: str = "gemini-1.5-flash", temperature: float = 0.2, top_p: float = 0.95, top_k: int = 40):
+    """
+    Thin wrapper around google-generativeai. Construct it once and reuse the
+    instance for the whole run: the SDK keeps one keep-alive channel, so
+    reusing the client (and its cached GenerativeModel objects) avoids a
+    fresh TLS handshake per call, which matters under the concurrent row
+    processing.
+    """
+
+    def __init__(self, model: str = "gemini-1.5-flash", temperature: float = 0.2, top_p: float = 0.95, top_k: int = 40, cache: bool = True, service_tier: str = "standard"):
         api_key = os.getenv("GEMINI_API_KEY")
         self.enabled = api_key is not None and len(api_key.strip()) > 0
         self.model_name = model
+        # "flex" halves cost for latency-insensitive runs, "priority" buys
+        # low latency for user-facing calls. If the installed SDK doesn't
+        # accept the option we note that once and stick to Standard.
+        self.service_tier = service_tier
+        self._tier_supported = True
         self.generation_config = {
             "temperature": temperature,
             "top_p": top_p,
             "top_k": top_k,
+            # strict JSON replies, so the extraction fallback rarely runs
+            "response_mime_type": "application/json",
         }
+        self._batch_client_instance = None
+        # Server-side context caches for the static system prompts (90%
+        # cheaper cached input tokens); filled lazily, one per prompt.
+        self._context_models: Dict[str, Any] = {}
+        # On-disk response cache: identical prompts (reruns, duplicate reviews)
+        # are answered from sqlite instead of hitting the API again.
+        self.cache_enabled = cache
+        self._cache_path = ".gemini_cache.sqlite"
+        self._cache_conn = None
         if self.enabled:
+            # Configure once and keep the SDK's default transport: the async
+            # path needs grpc_asyncio (forcing "rest" hands the async client
+            # a sync transport and every await blows up). The SDK caches the
+            # channel, so all calls share one keep-alive connection; models
+            # are built here and in _model_for only, never per request.
             genai.configure(api_key=api_key)
             self.model = genai.GenerativeModel(model)
         else:
             self.model = None
 
+    @staticmethod
+    def build_prompt(system_prompt: str, user_content: str) -> str:
+        prefix = _PROMPT_PREFIXES.get(system_prompt)
+        if prefix is None:
+            prefix = _PROMPT_PREFIXES.setdefault(system_prompt, f"{system_prompt}\n\nUser Input:\n")
+        return prefix + user_content + _PROMPT_SUFFIX
+
+    @staticmethod
+    def _parse_json(text: str) -> Optional[Dict[str, Any]]:
+        # orjson when available (C parser, 2-5x faster); Gemini typically
+        # returns valid JSON when asked, so the regex extraction is rare.
+        try:
+            return _json_loads(text)
+        except Exception:
+            m = _JSON_RE.search(text)
+            if m:
+                try:
+                    return _json_loads(m.group(0))
+                except Exception:
+                    return None
+        return None
+
+    def _cache_db(self):
+        if self._cache_conn is None:
+            conn = sqlite3.connect(self._cache_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT)")
+            self._cache_conn = conn
+        return self._cache_conn
+
+    def _cache_key(self, system_prompt: str, user_content: str) -> str:
+        raw = (self.model_name + system_prompt + user_content).encode()
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    def _cache_get(self, key: str) -> Optional[Dict[str, Any]]:
+        row = self._cache_db().execute("SELECT value FROM cache WHERE key=?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _cache_put(self, key: str, value: Dict[str, Any]):
+        conn = self._cache_db()
+        conn.execute("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+        conn.commit()
+
+    def _model_for(self, system_prompt: str):
+        """
+        Returns a model bound to a server-side cached copy of the system
+        prompt, falling back to the shared model when context caching is
+        unavailable (e.g. the prompt is below the caching minimum).
+        """
+        model = self._context_models.get(system_prompt)
+        if model is None:
+            try:
+                cached = genai.caching.CachedContent.create(
+                    model=self.model_name, system_instruction=system_prompt, ttl="1h")
+                model = genai.GenerativeModel.from_cached_content(cached_content=cached)
+            except Exception:
+                model = self.model
+            self._context_models[system_prompt] = model
+        return model
+
+    def _request_parts(self, system_prompt: str, user_content: str):
+        # With a context-cached system prompt only the user content is sent.
+        model = self._model_for(system_prompt)
+        if model is self.model:
+            return model, self.build_prompt(system_prompt, user_content)
+        return model, f"User Input:\n{user_content}\n\nReturn a valid JSON only."
+
+    def _use_tier(self) -> bool:
+        return self._tier_supported and bool(self.service_tier) and self.service_tier != "standard"
+
+    def _generate(self, model, prompt: str):
+        if self._use_tier():
+            try:
+                return model.generate_content(
+                    [prompt], generation_config=self.generation_config,
+                    request_options={"service_tier": self.service_tier})
+            except TypeError:
+                # SDK doesn't accept service_tier; don't try again.
+                # API errors (429/503, tier exhausted) propagate to the
+                # caller's retry logic instead of being swallowed here.
+                self._tier_supported = False
+        return model.generate_content([prompt], generation_config=self.generation_config)
+
+    async def _generate_async(self, model, prompt: str):
+        if self._use_tier():
+            try:
+                return await model.generate_content_async(
+                    [prompt], generation_config=self.generation_config,
+                    request_options={"service_tier": self.service_tier})
+            except TypeError:
+                # SDK doesn't accept service_tier; don't try again.
+                # API errors (429/503, tier exhausted) propagate to the
+                # caller's retry logic instead of being swallowed here.
+                self._tier_supported = False
+        return await model.generate_content_async([prompt], generation_config=self.generation_config)
+
     def ask_json(self, system_prompt: str, user_content: str) -> Optional[Dict[str, Any]]:
         """
         Sends a structured instruction to Gemini and expects a JSON-ish reply.
@@ -27,19 +178,114 @@ class GeminiClient:
         """
         if not self.enabled:
             return None
-        prompt = f"{system_prompt}\n\nUser Input:\n{user_content}\n\nReturn a valid JSON only."
-        resp = self.model.generate_content([prompt], generation_config=self.generation_config)
+        if self.cache_enabled:
+            key = self._cache_key(system_prompt, user_content)
+            hit = self._cache_get(key)
+            if hit is not None:
+                return hit
+        model, prompt = self._request_parts(system_prompt, user_content)
+        resp = self._generate(model, prompt)
         text = (resp.text or "").strip()
-        # Try to extract JSON (Gemini typically returns valid JSON when asked)
+        parsed = self._parse_json(text)
+        if parsed is not None and self.cache_enabled:
+            self._cache_put(key, parsed)
+        return parsed
+
+    async def ask_json_async(self, system_prompt: str, user_content: str) -> Optional[Dict[str, Any]]:
+        """
+        Async variant of ask_json so many rows can be in flight concurrently.
+        Retries with exponential backoff (plus jitter) on 429/503.
+        """
+        if not self.enabled:
+            return None
+        if self.cache_enabled:
+            key = self._cache_key(system_prompt, user_content)
+            hit = self._cache_get(key)
+            if hit is not None:
+                return hit
+        model, prompt = self._request_parts(system_prompt, user_content)
+        delay = 1.0
+        resp = None
+        for attempt in range(5):
+            try:
+                resp = await self._generate_async(model, prompt)
+                break
+            except _RETRYABLE_ERRORS:
+                if attempt == 4:
+                    return None
+                await asyncio.sleep(delay + random.uniform(0, delay))
+                delay *= 2
+        text = (resp.text or "").strip()
+        parsed = self._parse_json(text)
+        if parsed is not None and self.cache_enabled:
+            self._cache_put(key, parsed)
+        return parsed
+
+    # ---------- Batch API (offline runs: ~50% cheaper, higher rate limits) ----------
+
+    def _batch_client(self):
+        # The Batch API lives in the newer google-genai SDK; create its client lazily
+        # so the per-call path keeps working without it.
+        if self._batch_client_instance is None:
+            from google import genai as google_genai
+            self._batch_client_instance = google_genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+        return self._batch_client_instance
+
+    def submit_batch(self, requests: List[Dict[str, str]]) -> Optional[str]:
+        """
+        Uploads a JSONL of prompts and starts a Gemini Batch API job.
+        Each request is {"key": <id>, "prompt": <full prompt>}.
+        Returns the job name, or None when the client is disabled.
+        """
+        if not self.enabled or not requests:
+            return None
+        client = self._batch_client()
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as f:
+            for req in requests:
+                line = {
+                    "key": req["key"],
+                    "request": {"contents": [{"parts": [{"text": req["prompt"]}]}]},
+                }
+                f.write(json.dumps(line) + "\n")
+            src_path = f.name
         try:
-            return json.loads(text)
-        except Exception:
-            # Best-effort JSON extraction (very light)
+            uploaded = client.files.upload(file=src_path, config={"mime_type": "application/jsonl"})
+        finally:
+            os.unlink(src_path)
+        job = client.batches.create(model=self.model_name, src={"file_name": uploaded.name})
+        return job.name
+
+    def fetch_batch(self, job_name: Optional[str], poll_seconds: int = 30) -> Dict[str, Dict[str, Any]]:
+        """
+        Polls a batch job until it finishes, then downloads the result file.
+        Returns {key -> parsed JSON dict}; keys with unparseable replies are omitted.
+        """
+        if job_name is None:
+            return {}
+        client = self._batch_client()
+        while True:
+            job = client.batches.get(name=job_name)
+            state = job.state.name
+            if state == "JOB_STATE_SUCCEEDED":
+                break
+            if state in ("JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"):
+                return {}
+            time.sleep(poll_seconds)
+        payload = client.files.download(file=job.dest.file_name)
+        if isinstance(payload, bytes):
+            payload = payload.decode("utf-8")
+        results: Dict[str, Dict[str, Any]] = {}
+        for line in payload.splitlines():
+            if not line.strip():
+                continue
             try:
-                start = text.find("{")
-                end = text.rfind("}")
-                if start != -1 and end != -1 and end > start:
-                    return json.loads(text[start:end+1])
+                entry = json.loads(line)
+                key = entry["key"]
+                parts = entry["response"]["candidates"][0]["content"]["parts"]
+                text = "".join(p.get("text", "") for p in parts).strip()
             except Exception:
-                return None
-        return None
+                continue
+            parsed = self._parse_json(text)
+            if parsed is not None:
+                results[key] = parsed
+        return results
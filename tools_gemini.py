@@ -2,10 +2,12 @@
 from __future__ import annotations
 import re
 import json
+import hashlib
 from dataclasses import dataclass, asdict
 from datetime import datetime
 from typing import Dict, Any, List, Tuple, Optional
 
+import numpy as np
 import pandas as pd
 
 from gemini_client import GeminiClient
@@ -43,21 +45,72 @@ PRAISE_TRIGGERS = ["love","amazing","perfect","best","smooth","works great"]
 COMPLAINT_TRIGGERS = ["slow","lag","expensive","poor","bad","annoying","ads","too many ads","pricey","support is"]
 SPAM_TRIGGERS = ["http","www","visit","free","money","channel","asdf","subscribe","coins","discount code"]
 
+# Priority order for trigger matching: first hit in this order wins.
+_TRIGGER_SETS = [
+    ("Spam", SPAM_TRIGGERS),
+    ("Bug", BUG_TRIGGERS),
+    ("Feature Request", FEATURE_TRIGGERS),
+    ("Praise", PRAISE_TRIGGERS),
+    ("Complaint", COMPLAINT_TRIGGERS),
+]
+_CATEGORY_RANK = {cat: i for i, (cat, _) in enumerate(_TRIGGER_SETS)}
+
+try:
+    import ahocorasick
+    _HAS_AHOCORASICK = True
+except ImportError:
+    _HAS_AHOCORASICK = False
+
+def _build_trigger_automaton():
+    # One automaton over all trigger sets: every pattern is matched in a
+    # single linear scan of the text instead of one substring search each.
+    A = ahocorasick.Automaton()
+    for cat, needles in _TRIGGER_SETS:
+        for w in needles:
+            existing = A.get(w, None)
+            if existing is None or _CATEGORY_RANK[cat] < _CATEGORY_RANK[existing[0]]:
+                A.add_word(w, (cat, w))
+    A.make_automaton()
+    return A
+
+_TRIGGER_AUTOMATON = _build_trigger_automaton() if _HAS_AHOCORASICK else None
+
+def _triggers_re(needles: List[str]) -> re.Pattern:
+    return re.compile("|".join(map(re.escape, needles)), re.IGNORECASE)
+
+_BUG_RE = _triggers_re(BUG_TRIGGERS)
+_FEATURE_RE = _triggers_re(FEATURE_TRIGGERS)
+_PRAISE_RE = _triggers_re(PRAISE_TRIGGERS)
+_COMPLAINT_RE = _triggers_re(COMPLAINT_TRIGGERS)
+_SPAM_RE = _triggers_re(SPAM_TRIGGERS)
+_SEVERE_BUG_RE = _triggers_re(["crash", "data loss"])
+
 def _contains_any(text: str, needles: List[str]) -> bool:
     t = text.lower()
     return any(n in t for n in needles)
 
 def fallback_classify(text: str, rating: Optional[float] = None) -> Tuple[str, float, str]:
-    if _contains_any(text, SPAM_TRIGGERS):
+    t = text.lower()
+    if _TRIGGER_AUTOMATON is not None:
+        hit = None
+        severe = False
+        for _, (cat, w) in _TRIGGER_AUTOMATON.iter(t):
+            if w in ("crash", "data loss"):
+                severe = True
+            if hit is None or _CATEGORY_RANK[cat] < _CATEGORY_RANK[hit]:
+                hit = cat
+    else:
+        severe = "crash" in t or "data loss" in t
+        hit = next((cat for cat, needles in _TRIGGER_SETS if _contains_any(text, needles)), None)
+    if hit == "Spam":
         return "Spam", 0.95, "spam trigger"
-    if _contains_any(text, BUG_TRIGGERS):
-        conf = 0.9 if ("crash" in text.lower() or "data loss" in text.lower()) else 0.75
-        return "Bug", conf, "bug trigger"
-    if _contains_any(text, FEATURE_TRIGGERS):
+    if hit == "Bug":
+        return "Bug", 0.9 if severe else 0.75, "bug trigger"
+    if hit == "Feature Request":
         return "Feature Request", 0.8, "feature trigger"
-    if _contains_any(text, PRAISE_TRIGGERS):
+    if hit == "Praise":
         return "Praise", 0.7, "praise trigger"
-    if _contains_any(text, COMPLAINT_TRIGGERS):
+    if hit == "Complaint":
         return "Complaint", 0.7, "complaint trigger"
     if rating is not None:
         if rating <= 2:
@@ -66,6 +119,35 @@ def fallback_classify(text: str, rating: Optional[float] = None) -> Tuple[str, f
             return "Praise", 0.55, "rating fallback"
     return "Other", 0.4, "default fallback"
 
+def fallback_classify_series(texts: pd.Series, ratings: pd.Series) -> pd.DataFrame:
+    """
+    Vectorized fallback_classify over whole columns: one regex pass per
+    trigger set instead of per-row Python loops. Same priority order and
+    confidences as the scalar version. Returns a DataFrame with columns
+    category, confidence, rationale aligned to the input index.
+    """
+    texts = texts.fillna("").astype(str)
+    spam = texts.str.contains(_SPAM_RE)
+    bug = texts.str.contains(_BUG_RE)
+    severe = texts.str.contains(_SEVERE_BUG_RE)
+    feature = texts.str.contains(_FEATURE_RE)
+    praise = texts.str.contains(_PRAISE_RE)
+    complaint = texts.str.contains(_COMPLAINT_RE)
+    ratings = pd.to_numeric(ratings, errors="coerce")
+    low_rating = ratings <= 2
+    high_rating = ratings >= 4
+
+    conds = [spam, bug & severe, bug, feature, praise, complaint, low_rating, high_rating]
+    cats = ["Spam", "Bug", "Bug", "Feature Request", "Praise", "Complaint", "Complaint", "Praise"]
+    confs = [0.95, 0.9, 0.75, 0.8, 0.7, 0.7, 0.55, 0.55]
+    rationales = ["spam trigger", "bug trigger", "bug trigger", "feature trigger",
+                  "praise trigger", "complaint trigger", "rating fallback", "rating fallback"]
+    return pd.DataFrame({
+        "category": np.select(conds, cats, default="Other"),
+        "confidence": np.select(conds, confs, default=0.4),
+        "rationale": np.select(conds, rationales, default="default fallback"),
+    }, index=texts.index)
+
 def fallback_bug_analysis(text: str, platform: str, app_version: str) -> Tuple[str, str, str]:
     sev = "High" if ("crash" in text.lower() or "data loss" in text.lower() or "can't login" in text.lower() or "cannot login" in text.lower()) else "Medium"
     details = f"Platform={platform}; Version={app_version}; Summary={text[:140]}"
@@ -81,11 +163,88 @@ def fallback_feature(text: str) -> Tuple[str, str, str]:
         return "Medium", f"Feature: {text[:140]}", "medium-impact trigger"
     return "Low", f"Feature: {text[:140]}", "low-impact default"
 
+# ---------- Duplicate detection ----------
+# Reviews repeat heavily ("app keeps crashing", "love it!!"); clustering them
+# lets the pipeline call Gemini once per cluster and fan the result out.
+
+try:
+    from datasketch import MinHash, MinHashLSH
+    _HAS_DATASKETCH = True
+except ImportError:
+    _HAS_DATASKETCH = False
+
+def _normalized_tokens(text: str) -> List[str]:
+    return re.sub(r"[^\w\s]", " ", text.lower()).split()
+
+def text_signature(text: str) -> str:
+    toks = _normalized_tokens(text)[:20]
+    return hashlib.blake2b(" ".join(toks).encode(), digest_size=16).hexdigest()
+
+def cluster_duplicate_texts(texts: List[str], threshold: float = 0.85) -> List[List[int]]:
+    """
+    Groups indices of duplicate texts. Exact duplicates are bucketed by a
+    normalized signature (lowercased, punctuation stripped, first 20 tokens);
+    near-duplicates are merged with MinHash LSH over 3-gram shingles when
+    datasketch is installed. Singleton clusters are returned as-is.
+    """
+    buckets: Dict[str, List[int]] = {}
+    for i, t in enumerate(texts):
+        buckets.setdefault(text_signature(t or ""), []).append(i)
+    clusters = list(buckets.values())
+    if not _HAS_DATASKETCH or len(clusters) < 2:
+        return clusters
+
+    lsh = MinHashLSH(threshold=threshold, num_perm=64)
+    hashes = {}
+    for ci, cluster in enumerate(clusters):
+        toks = _normalized_tokens(texts[cluster[0]] or "")
+        shingles = {" ".join(toks[j:j+3]) for j in range(max(len(toks) - 2, 1))}
+        m = MinHash(num_perm=64)
+        for s in shingles:
+            m.update(s.encode())
+        hashes[ci] = m
+        lsh.insert(str(ci), m)
+
+    # union-find over bucket ids so transitive near-duplicates end up together
+    parent = list(range(len(clusters)))
+    def _find(x: int) -> int:
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    for ci, m in hashes.items():
+        for other in lsh.query(m):
+            ra, rb = _find(ci), _find(int(other))
+            if ra != rb:
+                parent[rb] = ra
+
+    merged: Dict[int, List[int]] = {}
+    for ci, cluster in enumerate(clusters):
+        merged.setdefault(_find(ci), []).extend(cluster)
+    return list(merged.values())
+
 # ---------- CSV Utility ----------
 
 def read_csv_file(path: str) -> pd.DataFrame:
     return pd.read_csv(path)
 
+def iter_csv_chunks(path: str, chunk_rows: int = 1024):
+    """
+    Streams a CSV as pd.DataFrame chunks so large exports never sit fully in
+    RAM and LLM calls can start before parsing finishes. Uses pyarrow's
+    incremental reader when installed, else pandas' chunked reader.
+    """
+    try:
+        from pyarrow import csv as pacsv
+    except ImportError:
+        yield from pd.read_csv(path, chunksize=chunk_rows)
+        return
+    reader = pacsv.open_csv(path, read_options=pacsv.ReadOptions(block_size=8 << 20))
+    for batch in reader:
+        df = batch.to_pandas()
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start:start + chunk_rows]
+
 # ---------- Gemini-powered tools with fallback ----------
 
 def classify_with_gemini(g: GeminiClient, text: str, rating: Optional[float] = None) -> Tuple[str, float, str]:
@@ -124,30 +283,89 @@ def compose_ticket_with_gemini(g: GeminiClient, title_hint: str, body_hint: str)
     # fallback: just trim
     return title_hint[:80], body_hint[:400]
 
-def critic_with_gemini(g: GeminiClient, ticket: Dict[str, Any]) -> Dict[str, Any]:
+def fallback_critic(ticket: Dict[str, Any], inplace: bool = True) -> Dict[str, Any]:
+    # minimal sanity: Spam/Praise should never be High/Critical
+    corrected = ticket if inplace else ticket.copy()
+    if corrected.get("category") in ["Spam","Praise"] and corrected.get("priority") in ["High","Critical"]:
+        corrected["priority"] = "Low"
+    return corrected
+
+def critic_with_gemini(g: GeminiClient, ticket: Dict[str, Any], inplace: bool = True) -> Dict[str, Any]:
+    # callers own their ticket dicts, so corrections are applied in place by
+    # default rather than copying every row
     if g.enabled:
         out = g.ask_json(SYSTEM_CRITIC, json.dumps(ticket))
         if isinstance(out, dict):
             if out.get("ok") is True:
                 return ticket
             # merge corrections
-            corrected = ticket.copy()
+            corrected = ticket if inplace else ticket.copy()
             for k, v in out.items():
                 if k != "ok":
                     corrected[k] = v
             return corrected
-    # fallback: minimal sanity
-    corrected = ticket.copy()
-    if corrected.get("category") in ["Spam","Praise"] and corrected.get("priority") in ["High","Critical"]:
-        corrected["priority"] = "Low"
-    return corrected
+    return fallback_critic(ticket, inplace=inplace)
+
+# ---------- Async variants (same logic, awaitable for concurrent rows) ----------
+
+async def classify_with_gemini_async(g: GeminiClient, text: str, rating: Optional[float] = None) -> Tuple[str, float, str]:
+    payload = {"text": text, "rating": rating}
+    if g.enabled:
+        out = await g.ask_json_async(SYSTEM_CLASSIFIER, json.dumps(payload))
+        if isinstance(out, dict) and "category" in out:
+            cat = out.get("category", "Other")
+            conf = float(out.get("confidence", 0.6))
+            rationale = out.get("brief_rationale", "")
+            return cat, conf, rationale
+    return fallback_classify(text, rating)
+
+async def analyze_bug_with_gemini_async(g: GeminiClient, text: str, platform: str, app_version: str) -> Tuple[str, str, str]:
+    payload = {"text": text, "platform": platform, "version": app_version}
+    if g.enabled:
+        out = await g.ask_json_async(SYSTEM_BUG_ANALYZER, json.dumps(payload))
+        if isinstance(out, dict) and "severity" in out:
+            return out.get("severity", "Medium"), out.get("technical_details", ""), out.get("brief_rationale","")
+    return fallback_bug_analysis(text, platform, app_version)
+
+async def extract_feature_with_gemini_async(g: GeminiClient, text: str) -> Tuple[str, str, str]:
+    payload = {"text": text}
+    if g.enabled:
+        out = await g.ask_json_async(SYSTEM_FEATURE_EXTRACTOR, json.dumps(payload))
+        if isinstance(out, dict) and "impact" in out:
+            return out.get("impact", "Low"), out.get("details", f"Feature: {text[:140]}"), out.get("suggested_title","Feature")
+    return fallback_feature(text)
+
+async def compose_ticket_with_gemini_async(g: GeminiClient, title_hint: str, body_hint: str) -> Tuple[str, str]:
+    payload = {"title_hint": title_hint[:120], "body_hint": body_hint[:500]}
+    if g.enabled:
+        out = await g.ask_json_async(SYSTEM_TICKET_CREATOR, json.dumps(payload))
+        if isinstance(out, dict) and "title" in out and "body" in out:
+            return out["title"][:80], out["body"]
+    # fallback: just trim
+    return title_hint[:80], body_hint[:400]
+
+async def critic_with_gemini_async(g: GeminiClient, ticket: Dict[str, Any], inplace: bool = True) -> Dict[str, Any]:
+    if g.enabled:
+        out = await g.ask_json_async(SYSTEM_CRITIC, json.dumps(ticket))
+        if isinstance(out, dict):
+            if out.get("ok") is True:
+                return ticket
+            # merge corrections
+            corrected = ticket if inplace else ticket.copy()
+            for k, v in out.items():
+                if k != "ok":
+                    corrected[k] = v
+            return corrected
+    return fallback_critic(ticket, inplace=inplace)
 
 # ---------- Ticket creation & metrics ----------
 
 def create_ticket(feedback_id: str, source_type: str, category: str,
                   priority: str, title: str, technical_details: str,
-                  confidence: float, link_back: str) -> Ticket:
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                  confidence: float, link_back: str,
+                  created_at: Optional[str] = None) -> Ticket:
+    # strftime per ticket is wasteful; callers pass one timestamp per run.
+    now = created_at or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     return Ticket(
         ticket_id=f"T{feedback_id}",
         source_id=str(feedback_id),
@@ -165,16 +383,17 @@ def compute_metrics(processing_log: pd.DataFrame,
                     expected: pd.DataFrame | None = None) -> pd.DataFrame:
     metrics = {}
     metrics["total_items"] = len(processing_log)
+    # one pass over the category column instead of one mask per category
+    counts = processing_log["category"].value_counts() if len(processing_log) else {}
     for k in ["Bug","Feature Request","Praise","Complaint","Spam","Other"]:
-        metrics[k.lower().replace(" ", "_")] = int((processing_log["category"] == k).sum())
+        metrics[k.lower().replace(" ", "_")] = int(counts.get(k, 0))
     metrics["avg_confidence"] = float(processing_log["confidence"].mean() if len(processing_log) else 0.0)
     if expected is not None and "category" in expected.columns:
-        # Ensure source_id columns are both string type
-        processing_log["source_id"] = processing_log["source_id"].astype(str)
-        expected["source_id"] = expected["source_id"].astype(str)
-        merged = processing_log.merge(expected, on="source_id", suffixes=("", "_expected"))
-        if "category_expected" in merged.columns:
-            acc = (merged["category"] == merged["category_expected"]).mean() if len(merged) else 0.0
-            metrics["category_accuracy"] = float(acc)
+        # align on source_id (both as strings) instead of building a merged frame
+        got = processing_log.assign(source_id=processing_log["source_id"].astype(str)).set_index("source_id")["category"]
+        want = expected.assign(source_id=expected["source_id"].astype(str)).set_index("source_id")["category"]
+        common = got.index.intersection(want.index)
+        acc = got.loc[common].eq(want.loc[common]).mean() if len(common) else 0.0
+        metrics["category_accuracy"] = float(acc)
     print((metrics))
     return pd.DataFrame([metrics])